@@ -7,6 +7,8 @@ VERSION = 'UniversalBackup.py v0.2'
 # Options:
 #   -d          - turn on debugging output
 #   -l [file]   - redirect stdout to the [file]
+#   -p, --plan  - only show what would be copied/removed, change nothing
+#                 (no manifest is written then)
 #
 # This program acts as an universal backup utility, which intends
 # to copy selected files from one place to another. Files to be copied,
@@ -22,9 +24,15 @@ VERSION = 'UniversalBackup.py v0.2'
 # ------------------------------
 # backup_dir: Drive:\Default\backup\dir
 # after_backup: cmd-line-to-execute-after-backup
+# after_backup_mode: sequence
+# after_backup_timeout: 600
+# trash_dir: Drive:\Trash\for\mirrored\files
+# manifest: Drive:\Logs\manifest-%Y%m%d-%H%M%S.ndjson
+# manifest_hash: md5
 # # comment
 # [label]
 # recursive
+# mirror
 # dst: \path\relative\to\backup_dir
 # path: Drive:\Path\to\the\files
 # +exts: c cpp h txt
@@ -44,12 +52,50 @@ VERSION = 'UniversalBackup.py v0.2'
 #           will be copied, unless indicated otherwise inside a section     
 #   after_backup - command line / program commands to execute after
 #           successful backup. User can specify 
-#           more then one of those fields.
+#           more then one of those fields. Commands get following
+#           environment variables: UB_BACKUP_DIR, UB_CHANGED_COUNT,
+#           UB_CHANGED_LIST, UB_REMOVED_COUNT and UB_REMOVED_LIST, where
+#           *_LIST is a path to the file listing copied/removed files
+#           (one per line), and UB_MANIFEST when manifest is written.
+#           The lists are unique UniversalBackup-*.txt files in the
+#           temporary directory. They are removed once commands finish,
+#           or - in the 'detach' mode - by a run started a day later.
+#   after_backup_mode - how to run after_backup commands:
+#           detach - start them and do not wait (default),
+#           parallel - run them concurrently and wait for all of them,
+#           sequence - run them one after another, stopping at first
+#               failed one.
+#           In two latter modes exit codes and durations are reported.
+#           Commands killed due to timeout are killed along with
+#           processes they have started.
+#   after_backup_timeout - number of seconds after which every
+#           after_backup command will be killed (0 - no limit, default).
+#           Not applied to the 'detach' mode.
+#   trash_dir - where files removed by 'mirror' sections will be moved
+#           to (into a per-run subdirectory). When not specified,
+#           such files are deleted permanently.
+#   manifest - path of the per-run manifest file, which may contain
+#           strftime codes (e.g. %Y%m%d). Every copied, skipped (up-to-date),
+#           failed and removed file is appended to it as a line of JSON
+#           (status, src, dst, size, mtime, and trash for trashed
+#           files) while backup goes on, so it can be tailed by other
+#           tools. When the pattern resolves to an existing file (e.g.
+#           %Y only), records of the run are appended to it. Names not
+#           decodable in the filesystem encoding are written as latin-1.
+#   manifest_hash - hash algorithm (md5, sha1, sha256...) for the 'hash'
+#           field of copied files in the manifest. Not computed by default.
 #   comment - stands for a regular comment, that will be skipped
 #   label - files section name, separetes files groups
 #   [no]recursive - specifies wheter to backup files recursively.
 #           When 'norecursive' is met, then group will not be scanned
 #           recursively. This is by default.
+#   [no]mirror - when 'mirror' is met, files inside section's destination
+#           directory that are no longer present (or are filtered out)
+#           in the source will be removed from the backup.
+#           Subdirectories holding other sections are left intact.
+#           Sections without 'dst' (stored directly in backup_dir) or
+#           sharing destination directory with other sections are not
+#           mirrored. 'nomirror' is a default.
 #   dst - supersedes backup_dir or acts as a relative path to the backup_dir
 #   path - specifies file/directory path to file/files that need
 #           to be backed up. Path can be relative to the current script's
@@ -70,7 +116,13 @@ VERSION = 'UniversalBackup.py v0.2'
 import os
 import sys
 import re
+import glob
+import signal
 import shutil
+import tempfile
+import time
+import json
+import hashlib
 from subprocess import Popen
 from datetime import datetime
 
@@ -97,6 +149,27 @@ g_BackupDir = ""
 
 # Commands line to execute after backup
 g_AfterBackup = []
+g_AfterBackupMode = "detach"
+g_AfterBackupTimeout = 0
+
+# Directory for files removed by mirror sections (empty - delete them).
+g_TrashDir = ""
+
+# Destination subtrees of every section as (root, recursive, section
+# index) tuples, the ones of sections having 'mirror' flag, and sets of
+# destination paths (normcase'd) of files from the filtered source listing
+# of each mirrored section, keyed by section index.
+# All are filled by traverse_paths().
+g_DstRoots = []
+g_MirrorRoots = []
+g_Expected = {}
+
+# Manifest path (strftime pattern), hash algorithm, opened manifest
+# file and count of written records per status.
+g_Manifest = ""
+g_ManifestHash = ""
+g_ManifestFile = None
+g_ManifestCount = {}
 
 # DO NOT ALTER ELEMENTS POSITION INSIDE THIS TUPLE!
 # Further code strongly depends on those positions.
@@ -132,6 +205,11 @@ def parse_file( lines):
     global g_Sections
     global g_BackupDir
     global g_AfterBackup
+    global g_AfterBackupMode
+    global g_AfterBackupTimeout
+    global g_TrashDir
+    global g_Manifest
+    global g_ManifestHash
     global g_ValidFields
 
     # files group to be added to g_Sections
@@ -155,6 +233,8 @@ def parse_file( lines):
                 # recursive flag does not occur, and one and set to zero.
                 if "recursive" not in group.keys():
                     group["recursive"] = 0
+                if "mirror" not in group.keys():
+                    group["mirror"] = 0
 
                 # append just parsed group to sections list.
                 g_Sections.append(group)
@@ -182,6 +262,32 @@ def parse_file( lines):
             elif m[0] == "norecursive":
                 continue
 
+            elif m[0] == "mirror":
+                # set mirror flag
+                group["mirror"] = 1
+
+            elif m[0] == "nomirror":
+                continue
+
+            elif m[0] == "trash_dir":
+                if g_TrashDir != "":
+                    print "Already got trash_dir. "\
+                            "Skipping another declaration.."
+                    continue
+                g_TrashDir = m[1].strip('\"')
+
+            elif m[0] == "manifest":
+                g_Manifest = m[1].strip('\"')
+
+            elif m[0] == "manifest_hash":
+                try:
+                    hashlib.new( m[1].lower())
+                    g_ManifestHash = m[1].lower()
+                except ValueError:
+                    print "[?] Line %d: unknown manifest_hash '%s'. "\
+                            "Skipping..." % (i, m[1][:25])
+                    continue
+
             elif m[0] == "backup_dir":
                 if g_BackupDir != "":
                     print "Already got backup_dir. "\
@@ -202,6 +308,21 @@ def parse_file( lines):
                     print "Skipping after_backup declaration..."
                     continue
 
+            elif m[0] == "after_backup_mode":
+                if m[1].lower() not in ("detach", "parallel", "sequence"):
+                    print "[?] Line %d: unknown after_backup_mode '%s'. "\
+                            "Skipping..." % (i, m[1][:25])
+                    continue
+                g_AfterBackupMode = m[1].lower()
+
+            elif m[0] == "after_backup_timeout":
+                try:
+                    g_AfterBackupTimeout = float(m[1])
+                except ValueError:
+                    print "[?] Line %d: invalid after_backup_timeout '%s'. "\
+                            "Skipping..." % (i, m[1][:25])
+                    continue
+
             elif len(m) == 2:
                 field = m[0].lower()
                 data = ""
@@ -269,6 +390,8 @@ def parse_file( lines):
     if len(group.keys() ):
         if "recursive" not in group.keys():
             group["recursive"] = 0
+        if "mirror" not in group.keys():
+            group["mirror"] = 0
         g_Sections.append( group)
     
     if len(g_Sections) == 0:
@@ -283,12 +406,13 @@ def parse_file( lines):
 
 # ========================
 
-def validate_sections():
+def validate_sections( plan = 0):
     """
     This procedure will check if specified paths exists in the system,
     then validate specified extensions if they meets extensions criterias.
     Nextly will try to evaluate possible 'dst' paths that are relative to
-    'backup_dir'.
+    'backup_dir'. When 'plan' is set, missing directories are only
+    reported instead of being created.
     """
     
     global g_Sections
@@ -297,7 +421,10 @@ def validate_sections():
 
     # Firstly have to check if backup_dir exists. If not, will try to
     # create this directory
-    if not os.path.exists(g_BackupDir):
+    if not os.path.exists(g_BackupDir) and plan:
+        print "[plan] Directory backup_dir doesn't exists. "\
+                "Would be created."
+    elif not os.path.exists(g_BackupDir):
         try:
             os.makedirs(g_BackupDir)
             print "[?] Successfully created directory backup_dir."
@@ -360,7 +487,12 @@ def validate_sections():
 
             sect["dst"] = sect["dst"].strip('\"')
 
-            if not os.path.isabs(sect["dst"]):
+            if plan:
+                if not os.path.exists( os.path.join( \
+                        g_BackupDir, sect["dst"])):
+                    print "[plan] Directory: '%s' doesn't exists."\
+                            " Would be created." % sect["dst"]
+            elif not os.path.isabs(sect["dst"]):
                 if not os.path.exists( os.path.join( \
                         g_BackupDir, sect["dst"])):
                     print "[?] Directory: '%s' doesn't exists."\
@@ -437,19 +569,30 @@ def traverse_paths():
     of files that should be backed up. At every file will perform sort
     of checking (MD5 hashing) with existing in backup_dir file. This 
     will help omitting files already up-to-date in backup_dir.
+    Destination subtrees of sections are gathered into g_DstRoots. For
+    sections having 'mirror' flag, destination paths of their filtered
+    files are also gathered into g_Expected sets, along with destination
+    subtrees to be mirrored in g_MirrorRoots.
     """
 
     global g_Sections
     global g_BackupDir
     global g_ValidFields
+    global g_DstRoots
+    global g_Expected
+    global g_MirrorRoots
 
     src_files = []
     dst_files = []
     raw_list = []
 
-    for sect in g_Sections:
+    for (idx, sect) in enumerate(g_Sections):
+        if sect.get("mirror"):
+            g_Expected[idx] = set()
+
         paths = sect["path"]
         sdst = ""
+        errors = []
 
         exts = []
         inc = 1     # inclusion flag
@@ -470,19 +613,34 @@ def traverse_paths():
                 sdst = ""
 
             if os.path.isdir( path):
-                _raw_list = set(walk_path( path, sect["recursive"]))
+                _raw_list = set(walk_path( path, sect["recursive"], errors))
                 dir = 1
 
                 # Adding last dir from path to the dstpath.
-                if "/" in sdst:
-                    sdst = os.path.join(sdst, path.strip("/").\
-                            split("/")[-1])
-                else:
-                    sdst = os.path.join(sdst, path.strip("\\").\
-                            split("\\")[-1])
+                sdst = os.path.join(sdst, \
+                        os.path.basename(os.path.normpath(path)))
             else:
                 _raw_list = [path,]
 
+            # Destination subtree of this path. Single files land directly
+            # in the dst dir, so that one is not scanned recursively.
+            if "dst" not in sect.keys():
+                root = g_BackupDir
+            else:
+                root = os.path.join(g_BackupDir, sdst)
+            root = (os.path.abspath(root), dir and sect["recursive"], idx)
+            if root not in g_DstRoots:
+                g_DstRoots.append(root)
+
+            if sect.get("mirror"):
+                src = os.path.normcase(os.path.abspath(path))
+                if os.path.normcase(os.path.abspath(root[0])+os.sep).\
+                        startswith(src+os.sep):
+                    print "[!] Destination of '%s' lies inside its source."\
+                            " Will not mirror it." % sect["label"]
+                elif root not in g_MirrorRoots:
+                    g_MirrorRoots.append(root)
+
             # filtering extensions
             raw_list = []
             for e in _raw_list:
@@ -526,6 +684,9 @@ def traverse_paths():
                         tail = "".join(tail)
                     p = os.path.join(g_BackupDir, tail)
 
+                if sect.get("mirror"):
+                    g_Expected[idx].add( os.path.normcase( \
+                            os.path.abspath(p)))
                 
                 # Now check file's modification time, in order of omitting
                 # files already backed up in their last versions.
@@ -536,7 +697,7 @@ def traverse_paths():
                     dstMtime = 0
                     if os.path.exists( p):
                         dstMtime = os.path.getmtime( p)
-                except WindowsError as er:
+                except OSError as er:
                     if er.errno == 2:
                         pass
                 except:
@@ -546,39 +707,475 @@ def traverse_paths():
 
                 if int(dstMtime) == int(srcMtime):
                     dbg( "File '%s' is already up-to-date." % p)
+                    manifest_write( "skipped", e, p, p)
                 else:
                     src_files.append(e)
                     dst_files.append(p)
 
+        if sect.get("mirror") and len(errors):
+            # Files of unreadable directories are missing from the
+            # listing, so mirroring would remove their backups.
+            print "[!] Couldn't read whole source of '%s'. "\
+                    "Will not mirror it." % sect["label"]
+            g_MirrorRoots[:] = [r for r in g_MirrorRoots if r[2] != idx]
+
     return (src_files, dst_files)
 
 
 # ========================
 
-def walk_path( path, recursive):
+def walk_path( path, recursive, errors = None):
     """
     This function walks entire path tree and collects every file listed
     Can perform traversing through path recursively or not, depending on 
-    a second parameter value (boolean). 
+    a second parameter value (boolean). Directories which couldn't be
+    read are reported and appended to the 'errors' list (if given).
     """
 
     files = []
     r = [".", ".."]
 
+    def onerror( er):
+        print "[!] Couldn't read directory: '%s'" % er.filename
+        if errors != None:
+            errors.append( er.filename)
+
     print "Walking through '%s'..." % path
 
     if recursive:
-        for (root, dirs, _files) in os.walk( path):
+        for (root, dirs, _files) in os.walk( path, onerror = onerror):
             files.extend( [ os.path.join(root, f) for f in \
                             _files if f not in r] )
     else:
-        _files = os.listdir(path)
+        try:
+            _files = os.listdir(path)
+        except OSError as er:
+            onerror( er)
+            _files = []
         _files = [ os.path.join(path, f) for f in _files]
         files.extend( [ f for f in _files if not os.path.isdir(f)] )
 
     return files
 
 
+# ========================
+
+def mirror_sections( plan):
+    """
+    Walks destination subtrees of sections flagged with 'mirror' and
+    removes every file which is not present in the section's g_Expected
+    set (that is - was deleted or filtered out in the source). Files are
+    either deleted or moved into a per-run subdirectory of trash_dir.
+    Destination is walked lazily and looked up in a hashed set, so no
+    listing of the backup_dir is being built. Subtrees which belong to
+    other sections are left intact, and sections stored directly in
+    backup_dir or sharing destination with other sections are not
+    mirrored at all. When 'plan' is set, only prints what would be done.
+    Returns list of removed files.
+    """
+
+    global g_Sections
+    global g_BackupDir
+    global g_TrashDir
+    global g_DstRoots
+    global g_Expected
+    global g_MirrorRoots
+    global g_Manifest
+    global g_ManifestFile
+
+    removed = []
+    trash = ""
+    skip = ""
+    if g_TrashDir != "":
+        trash = os.path.join(g_TrashDir, \
+                datetime.now().strftime("%Y%m%d-%H%M%S"))
+        skip = os.path.normcase(os.path.abspath(g_TrashDir))
+
+    # never mirror the manifest (being) written
+    manifest = ""
+    if g_Manifest != "":
+        manifest = os.path.normcase(os.path.abspath(g_Manifest))
+
+    for (root, recursive, idx) in g_MirrorRoots:
+        if not os.path.isdir( root):
+            continue
+
+        label = g_Sections[idx]["label"]
+        nroot = os.path.normcase(root)
+
+        if nroot == os.path.normcase(os.path.abspath(g_BackupDir)):
+            print "[!] Section '%s' is stored directly in backup_dir. "\
+                    "Will NOT mirror it, as that would remove files "\
+                    "of everything else there. Specify 'dst' for it." % label
+            continue
+
+        # Destination subtrees of other sections. Files in the same
+        # directory (or below recursive one) can not be told apart.
+        other = [(os.path.normcase(r), rec) for (r, rec, i) in g_DstRoots \
+                if i != idx]
+        shared = [r for (r, rec) in other if r == nroot or \
+                (rec and nroot.startswith(r + os.sep))]
+        if len(shared):
+            print "[!] Destination '%s' of section '%s' is shared with "\
+                    "other sections. Will not mirror it." % (root, label)
+            continue
+
+        prune = set([r for (r, rec) in other \
+                if r.startswith(nroot + os.sep)])
+        if skip != "":
+            # never mirror the trash itself
+            prune.add(skip)
+        expected = g_Expected[idx]
+
+        print "Mirroring '%s'..." % root
+
+        for (dirpath, dirs, _files) in os.walk( root):
+            if not recursive:
+                del dirs[:]
+            else:
+                dirs[:] = [d for d in dirs if os.path.normcase( \
+                        os.path.join(dirpath, d)) not in prune]
+
+            for f in _files:
+                f = os.path.join(dirpath, f)
+                if os.path.normcase(f) in expected or \
+                        os.path.normcase(f) == manifest:
+                    continue
+
+                if trash != "":
+                    try:
+                        rel = os.path.relpath(f, g_BackupDir)
+                    except ValueError:
+                        # dst on another drive than backup_dir
+                        rel = ".."
+                    if rel.startswith(".."):
+                        # dst outside of backup_dir
+                        rel = os.path.splitdrive(f)[1].lstrip("/\\")
+                    t = os.path.join(trash, rel)
+
+                if plan:
+                    if trash != "":
+                        print "[plan] TRASH '%s' => '%s'" % (f, t)
+                    else:
+                        print "[plan] REMOVE '%s'" % f
+                    removed.append(f)
+                    continue
+
+                try:
+                    if trash != "":
+                        dbg("TRASH '%s' => '%s'" % (f, t))
+                        if not os.path.exists( os.path.dirname(t)):
+                            os.makedirs( os.path.dirname(t))
+                        shutil.move( f, t)
+                        manifest_write( "trashed", None, f, t, trash = t)
+                    else:
+                        dbg("REMOVE '%s'" % f)
+                        os.remove( f)
+                        manifest_write( "removed", None, f)
+                    removed.append(f)
+                except (IOError, OSError, shutil.Error) as er:
+                    print "[!] Couldn't remove the file: '%s'" % f
+                    manifest_write( "failed", None, f, f, error = str(er))
+
+    return removed
+
+
+# ========================
+
+def manifest_open():
+    """
+    Opens this run's manifest file (appending to it, if it already
+    exists) and writes the opening record. On failure backup goes on
+    without a manifest.
+    """
+
+    global g_Manifest
+    global g_ManifestFile
+
+    try:
+        d = os.path.dirname(g_Manifest)
+        if d != "" and not os.path.exists(d):
+            os.makedirs(d)
+        g_ManifestFile = open(g_Manifest, "a")
+    except (IOError, OSError):
+        print "[!] Couldn't create the manifest: '%s'" % g_Manifest
+        g_Manifest = ""
+        return
+
+    manifest_record( {"status": "start", "version": VERSION,
+            "time": datetime.now().isoformat()})
+
+
+def manifest_record( rec):
+    """
+    Writes single JSON line into the manifest and flushes it,
+    so that consumers can tail the file while backup goes on.
+    """
+
+    global g_Manifest
+    global g_ManifestFile
+
+    if g_ManifestFile == None:
+        return
+
+    enc = sys.getfilesystemencoding() or "utf-8"
+    for k in rec.keys():
+        if type(rec[k]) == type(""):
+            try:
+                rec[k] = rec[k].decode(enc)
+            except UnicodeDecodeError:
+                # Undecodable name - latin-1 keeps every byte of it.
+                rec[k] = rec[k].decode("latin-1")
+
+    try:
+        g_ManifestFile.write( json.dumps(rec, sort_keys = True) + "\n")
+        g_ManifestFile.flush()
+    except (IOError, ValueError) as er:
+        # Backup has to go on even without the manifest.
+        print "\n[!] Couldn't write to the manifest: '%s'" % g_Manifest
+        try:
+            g_ManifestFile.close()
+        except IOError:
+            pass
+        g_ManifestFile = None
+
+
+def manifest_write( status, src, dst, path = None, digest = 0, \
+        error = None, trash = None):
+    """
+    Records a file with given status in the manifest. Size and mtime
+    are taken from the 'path' file (if any), and when 'digest' is set
+    and manifest_hash was specified - also its hash. 'trash' is the
+    location of trashed file.
+    """
+
+    global g_ManifestFile
+    global g_ManifestHash
+    global g_ManifestCount
+
+    if g_ManifestFile == None:
+        return
+
+    g_ManifestCount[status] = g_ManifestCount.get(status, 0) + 1
+    rec = {"status": status, "src": src, "dst": dst}
+
+    if path != None:
+        try:
+            st = os.stat(path)
+            rec["size"] = st.st_size
+            rec["mtime"] = st.st_mtime
+
+            if digest and g_ManifestHash != "":
+                h = hashlib.new(g_ManifestHash)
+                f = open(path, "rb")
+                buf = f.read(1 << 20)
+                while buf:
+                    h.update(buf)
+                    buf = f.read(1 << 20)
+                f.close()
+                rec["hash"] = h.hexdigest()
+        except (IOError, OSError):
+            pass
+
+    if error != None:
+        rec["error"] = error
+
+    if trash != None:
+        rec["trash"] = trash
+
+    manifest_record( rec)
+
+
+def manifest_close():
+    """
+    Writes the closing record with per-status counts and closes
+    the manifest.
+    """
+
+    global g_ManifestFile
+    global g_ManifestCount
+
+    if g_ManifestFile == None:
+        return
+
+    rec = dict(g_ManifestCount)
+    rec["status"] = "done"
+    rec["time"] = datetime.now().isoformat()
+    manifest_record( rec)
+
+    g_ManifestFile.close()
+    g_ManifestFile = None
+
+
+# ========================
+
+def kill_command( p):
+    """
+    Kills the command's process along with processes it has started
+    (e.g. by a shell script or a .cmd wrapper).
+    """
+
+    try:
+        if os.name == "nt":
+            null = open(os.devnull, "w")
+            Popen( ["taskkill", "/F", "/T", "/PID", str(p.pid)],
+                    stdout=null, stderr=null).wait()
+            null.close()
+        else:
+            # started in its own process group by run_after_backup()
+            os.killpg( p.pid, signal.SIGKILL)
+    except OSError:
+        # process has just finished on its own
+        pass
+
+    if p.poll() == None:
+        try:
+            p.kill()
+        except OSError:
+            pass
+
+
+# ========================
+
+def cleanup_lists():
+    """
+    Removes lists of changed/removed files left in the temporary directory
+    by earlier runs in the 'detach' mode, once they are a day old, which
+    leaves detached commands plenty of time to read them.
+    """
+
+    now = time.time()
+    for f in glob.glob( os.path.join(tempfile.gettempdir(), \
+            "UniversalBackup-*.txt")):
+        try:
+            st = os.lstat(f)
+            if hasattr(os, "getuid") and st.st_uid != os.getuid():
+                continue
+            if now - st.st_mtime > 24 * 3600:
+                os.remove(f)
+        except OSError:
+            pass
+
+
+# ========================
+
+def wait_commands( running):
+    """
+    Waits for processes from 'running' list of (process, result, start,
+    timeout) tuples to finish, killing those which exceeded their
+    timeout. Exit code, status and duration go to the result dictonary.
+    """
+
+    while len(running):
+        for c in running[:]:
+            (p, r, start, timeout) = c
+            r["time"] = time.time() - start
+
+            if p.poll() != None:
+                r["status"] = "ok"
+                if p.returncode != 0:
+                    r["status"] = "failed"
+            elif timeout and r["time"] > timeout:
+                kill_command( p)
+                p.wait()
+                r["status"] = "timeout"
+            else:
+                continue
+
+            r["code"] = p.returncode
+            running.remove(c)
+
+        if len(running):
+            time.sleep(0.1)
+
+
+# ========================
+
+def run_after_backup( changed, removed):
+    """
+    Executes after_backup commands according to after_backup_mode.
+    Lists of changed and removed files are written to unique files in
+    the temporary directory, which paths (along with files count) are
+    exposed to commands through environment variables, so they can
+    process only the delta. The lists are removed once commands finish,
+    unless these were detached.
+    Returns list of result dictonaries (cmd, status, code, time).
+    """
+
+    global g_AfterBackup
+    global g_AfterBackupMode
+    global g_AfterBackupTimeout
+    global g_BackupDir
+    global g_Manifest
+
+    env = dict(os.environ)
+    env["UB_BACKUP_DIR"] = g_BackupDir
+    if g_Manifest != "":
+        env["UB_MANIFEST"] = g_Manifest
+
+    cleanup_lists()
+    lists = []
+
+    for (name, files) in (("CHANGED", changed), ("REMOVED", removed)):
+        try:
+            (fd, lst) = tempfile.mkstemp(prefix="UniversalBackup-%s-" \
+                    % name.lower(), suffix=".txt")
+            f = os.fdopen(fd, "w")
+            for e in files:
+                f.write(e + "\n")
+            f.close()
+            env["UB_%s_LIST" % name] = lst
+            lists.append(lst)
+        except (IOError, OSError):
+            print "[!] Couldn't write the list of %s files." % name.lower()
+        env["UB_%s_COUNT" % name] = str(len(files))
+
+    # Commands which are waited for get their own process group,
+    # so that timed out ones can be killed with all their children.
+    kw = {}
+    if g_AfterBackupMode != "detach" and os.name != "nt":
+        kw["preexec_fn"] = os.setsid
+
+    results = []
+    running = []
+    failed = 0
+
+    for cmd in g_AfterBackup:
+        r = {"cmd": cmd, "status": "skipped", "code": None, "time": 0.0}
+        results.append(r)
+
+        if failed and g_AfterBackupMode == "sequence":
+            continue
+
+        dbg("EXEC '%s'" % cmd)
+        try:
+            p = Popen( [cmd], env=env, **kw)
+        except OSError as er:
+            print "[!] Couldn't execute: '%s'" % cmd
+            r["status"] = "failed"
+            failed = 1
+            continue
+
+        r["status"] = "started"
+        running.append( (p, r, time.time(), g_AfterBackupTimeout))
+
+        if g_AfterBackupMode == "sequence":
+            wait_commands( running)
+            if r["status"] != "ok":
+                failed = 1
+
+    if g_AfterBackupMode != "detach":
+        wait_commands( running)
+
+        for lst in lists:
+            try:
+                os.remove( lst)
+            except OSError:
+                pass
+
+    return results
+
+
 # ========================
 # main
 #
@@ -587,14 +1184,19 @@ if __name__ == '__main__':
 
     # Parse command line.
     log = 0
-    if len(sys.argv) >= 2:
-        if sys.argv[1] == "-d":
+    plan = 0
+    args = sys.argv[1:]
+    while len(args):
+        a = args.pop(0)
+        if a == "-d":
             DEBUG_VERSION = 1
             import pprint
-        elif sys.argv[1] == "-l":
+        elif a == "-p" or a == "--plan":
+            plan = 1
+        elif a == "-l":
             f = "log.txt"
-            if len(sys.argv) == 3:
-                f = sys.argv[2]
+            if len(args) and not args[0].startswith("-"):
+                f = args.pop(0)
             # redirecting standard output
             sys.stdout = open(f, 'a')
             log = 1
@@ -628,7 +1230,7 @@ if __name__ == '__main__':
 
     # Stage 2: Validating parsed sections
     print "Validating gathered sections..."
-    validate_sections()
+    validate_sections( plan)
 
     print "Done."
 
@@ -637,6 +1239,11 @@ if __name__ == '__main__':
         print "[dbg] Dumping g_Sections:"
         pprint.pprint( g_Sections)
 
+    if g_Manifest != "":
+        g_Manifest = datetime.now().strftime(g_Manifest)
+        if not plan:
+            manifest_open()
+
     # This will be a huge files list that are supposed to be backed up.
     src_files, dst_files = traverse_paths()
 
@@ -645,15 +1252,25 @@ if __name__ == '__main__':
 
     print ""
 
+    if plan:
+        # Only preview what would be done.
+        for i in range(len(src_files)):
+            print "[plan] COPY '%s' => '%s'" % (src_files[i], dst_files[i])
+        removed = mirror_sections( plan)
+        print "\nPlan: %d files to back up, %d files to remove." \
+                % (len(src_files), len(removed))
+        sys.exit(0)
+
     # Perform actual copying...
+    copied = []
     for i in range(len(src_files)):
 
         if os.path.exists(dst_files[i]) == False:
             try:
                 os.makedirs( os.path.dirname(dst_files[i]) )
-            except WindowsError as err:
+            except OSError as er:
                 # File already exists error... 
-                if err.errno == 183:
+                if er.errno == 183:
                     pass
 
         if DEBUG_VERSION == 0:
@@ -671,19 +1288,43 @@ if __name__ == '__main__':
 
         try:
             shutil.copy2( src_files[i], dst_files[i] )
-        except IOError as err:
-            if err.errno == 13:
+            copied.append( dst_files[i])
+            manifest_write( "copied", src_files[i], dst_files[i],
+                    dst_files[i], digest = 1)
+        except IOError as er:
+            if er.errno == 13:
                 print "[!] Couldn't copy the file: '%s'" % dst_files[i]
+            manifest_write( "failed", src_files[i], dst_files[i],
+                    src_files[i], error = str(er))
     
-    if len(src_files) == 0:
+    removed = []
+    if len(g_MirrorRoots):
+        print ""
+        removed = mirror_sections( plan)
+        if len(removed):
+            print "Removed %d files no longer present in source." \
+                    % len(removed)
+
+    # Consumers of the manifest may be run as post-backup commands.
+    manifest_close()
+
+    if len(src_files) == 0 and len(removed) == 0:
         print "\nThere was nothing to update or back up."
     else:
-        print "\nOperation completed. Backed up %d files." % len(src_files)
+        print "\nOperation completed. Backed up %d files." % len(copied)
 
         if len(g_AfterBackup):
             print "Performing post-backup operations..."
-            for e in g_AfterBackup:
-                Popen( [e] )
+            results = run_after_backup( copied, removed)
+
+            if g_AfterBackupMode != "detach":
+                print "\nPost-backup report:"
+                for r in results:
+                    code = "-"
+                    if r["code"] != None:
+                        code = "%d" % r["code"]
+                    print "    %-8s exit: %-4s %8.2fs  %s" % (r["status"],
+                            code, r["time"], r["cmd"][:45])
 
         print "All done. Good bye."
 